@@ -1,5 +1,13 @@
+import contextlib
+import functools
 import hashlib
+import importlib.util
+import json
 import logging
+import os
+import queue
+import threading
+import time
 from pathlib import Path
 
 import entrypoints
@@ -11,14 +19,26 @@ ENTRYPOINT = "brainio_lookups"
 TYPE_ASSEMBLY = 'assembly'
 TYPE_STIMULUS_SET = 'stimulus_set'
 CATALOG_PATH_KEY = "catalog_path"
+_catalog_cache_path = Path(os.path.expanduser(os.getenv('BRAINIO_HOME', '~/.brainio'))) / 'catalogs'
 _catalogs = {}
+_catalogs_lock = threading.Lock()
 _concat_catalogs = None
+_concat_names = ()
+_lookup_types = None
+_catalog_index = None
+_type_masks = {}
+_catalog_keys = {}
 
 _logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _catalog_loaders():
+    return entrypoints.get_group_named(ENTRYPOINT)
+
+
 def list_catalogs():
-    return list(entrypoints.get_group_named(ENTRYPOINT).keys())
+    return list(_catalog_loaders().keys())
 
 
 def load_lookup(name, entry_point):
@@ -36,48 +56,211 @@ def get_lookups():
     return dfs
 
 
+def get_catalog(name):
+    with _catalogs_lock:
+        if name not in _catalogs:
+            _catalogs[name] = _load_cached_lookup(name, _catalog_loaders()[name])
+    return _catalogs[name]
+
+
+def _load_cached_lookup(name, entry_point):
+    source = _entry_point_info(entry_point)
+    catalog = _read_lookup_cache(name, source)
+    if catalog is None:
+        _logger.debug(f"Loading lookup {name} from entrypoint")
+        loading_start_ns = time.time_ns()
+        catalog = load_lookup(name, entry_point)
+        _write_lookup_cache(name, catalog, source, modified_before_ns=loading_start_ns)
+    return catalog
+
+
+def _entry_point_info(entry_point):
+    # identifies the code that produces a catalog: a changed or different provider invalidates its cached catalog
+    try:
+        module_path = os.path.abspath(importlib.util.find_spec(entry_point.module_name).origin)
+        stat = os.stat(module_path)
+    except (ImportError, ValueError, AttributeError, TypeError, OSError) as e:
+        _logger.debug(f"Cannot locate the module of entrypoint {entry_point.name}: {e!r}")
+        return None
+    return {
+        'entry_point': f"{entry_point.module_name}:{entry_point.object_name}",
+        'version': getattr(entry_point.distro, 'version', None),
+        'module_path': module_path,
+        'module_mtime_ns': stat.st_mtime_ns,
+        'module_size': stat.st_size,
+    }
+
+
+def _catalog_cache_format():
+    # only data formats, so that a shared BRAINIO_HOME can never inject code. parquet is faster but optional
+    return 'parquet' if importlib.util.find_spec('pyarrow') is not None else 'json'
+
+
+def _catalog_cache_file(name, cache_format):
+    return _catalog_cache_path / (f"{name}.parquet" if cache_format == 'parquet' else f"{name}.table.json")
+
+
+def _read_lookup_cache(name, source):
+    # the cached catalog is only valid as long as neither its provider nor the catalog file it read have changed.
+    # This assumes that a provider's output only depends on its module and the catalog file it reports.
+    if source is None:
+        return None
+    try:
+        with open(_catalog_cache_path / f"{name}.json") as f:
+            cache_info = json.load(f)
+        if cache_info['source'] != source or cache_info['format'] != _catalog_cache_format():
+            return None
+        stat = os.stat(cache_info[CATALOG_PATH_KEY])
+        if [stat.st_mtime_ns, stat.st_size] != [cache_info['mtime_ns'], cache_info['size']]:
+            return None
+        cache_file = _catalog_cache_file(name, cache_info['format'])
+        if cache_info['format'] == 'parquet':
+            catalog = pd.read_parquet(cache_file)
+        else:
+            catalog = pd.read_json(cache_file, orient='table')
+        catalog.attrs = cache_info['attrs']
+        if catalog.attrs.get(CATALOG_PATH_KEY) != cache_info[CATALOG_PATH_KEY]:
+            return None
+    except Exception as e:
+        _logger.debug(f"No valid cache for lookup {name}: {e!r}")
+        return None
+    _logger.debug(f"Loaded lookup {name} from cache")
+    return catalog
+
+
+def _write_lookup_cache(name, catalog, source, modified_before_ns=None):
+    if source is None or CATALOG_PATH_KEY not in catalog.attrs:  # the cache could never be validated
+        return
+    catalog_path = catalog.attrs[CATALOG_PATH_KEY]
+    cache_format = _catalog_cache_format()
+    try:
+        stat = os.stat(catalog_path)
+        if modified_before_ns is not None and stat.st_mtime_ns >= modified_before_ns:
+            # the file might have changed after it was read, so it would not match the loaded catalog
+            _logger.debug(f"Not caching lookup {name}: {catalog_path} was modified while loading")
+            return
+        cache_info = {'source': source, 'format': cache_format, 'attrs': catalog.attrs,
+                      CATALOG_PATH_KEY: catalog_path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        cache_info = json.dumps(cache_info)  # fails early if the attrs cannot be stored
+        _catalog_cache_path.mkdir(parents=True, exist_ok=True)
+        cache_file = _catalog_cache_file(name, cache_format)
+        if cache_format == 'parquet':
+            catalog.to_parquet(cache_file, index=False)
+        else:
+            catalog.to_json(cache_file, orient='table', index=False)
+        with open(_catalog_cache_path / f"{name}.json", 'w') as f:  # written last, marks the cache as valid
+            f.write(cache_info)
+    except (OSError, TypeError, ValueError) as e:
+        _logger.warning(f"Could not cache lookup {name}: {e!r}")
+
+
 def get_catalogs():
-    global _catalogs
-    if not _catalogs:
-        _logger.debug(f"Loading lookup from entrypoints")
-        print(f"Loading lookup from entrypoints")
-        _catalogs = get_lookups()
-    return _catalogs
+    return {name: get_catalog(name) for name in _catalog_loaders()}
 
 
 def data():
+    get_catalogs()
+    return _loaded_data()
+
+
+def _loaded_data():
+    # concatenation of only those catalogs that have been loaded so far, in entrypoint order
     global _concat_catalogs
-    if _concat_catalogs is None:
-        catalogs = get_catalogs()
-        _concat_catalogs = pd.concat(catalogs.values(), ignore_index=True)
+    global _concat_names
+    global _lookup_types
+    global _catalog_index
+    global _type_masks
+    names = tuple(name for name in _catalog_loaders() if name in _catalogs)
+    if _concat_catalogs is None or names != _concat_names:
+        catalogs = [_catalogs[name] for name in names]
+        if len(catalogs) == 1:  # nothing to concatenate
+            _concat_catalogs = catalogs[0].reset_index(drop=True)
+        else:
+            _concat_catalogs = pd.concat(catalogs, ignore_index=True)
+        _concat_names = names
+        # a categorical copy of the lookup types: comparing against their codes is cheaper than comparing strings
+        _lookup_types = pd.Categorical(_concat_catalogs['lookup_type'])
+        # per catalog: its offset in the concatenation and the positions of its rows for (identifier, lookup_type)
+        _catalog_index, offset = {}, 0
+        for name, catalog in zip(names, catalogs):
+            _catalog_index[name] = (offset, catalog.groupby(['identifier', 'lookup_type']).indices)
+            offset += len(catalog)
+        _type_masks = {}
     return _concat_catalogs
 
 
+def _insert_rows(catalog_name, add_lookup):
+    # insert rows appended to a catalog at the end of its slice, keeping the concatenation in catalog order.
+    # Only the new rows are indexed, the catalogs after it just shift their offset
+    global _concat_catalogs
+    global _lookup_types
+    global _catalog_index
+    global _type_masks
+    catalog_offset, indices = _catalog_index[catalog_name]
+    end = catalog_offset + len(_catalogs[catalog_name]) - len(add_lookup)  # the catalog already holds the new rows
+    _concat_catalogs = pd.concat([_concat_catalogs.iloc[:end], add_lookup, _concat_catalogs.iloc[end:]],
+                                 ignore_index=True)
+    new_types = add_lookup['lookup_type'].values
+    missing_types = sorted(set(new_types) - set(_lookup_types.categories))
+    lookup_types = _lookup_types.add_categories(missing_types) if missing_types else _lookup_types
+    new_codes = pd.Categorical(new_types, categories=lookup_types.categories).codes
+    _lookup_types = pd.Categorical.from_codes(
+        np.concatenate([lookup_types.codes[:end], new_codes, lookup_types.codes[end:]]),
+        categories=lookup_types.categories)
+    _type_masks = {lookup_type: np.concatenate([mask[:end], new_types == lookup_type, mask[end:]])
+                   for lookup_type, mask in _type_masks.items()}
+    for position, key in enumerate(zip(add_lookup['identifier'], add_lookup['lookup_type']),
+                                   start=end - catalog_offset):
+        indices[key] = np.append(indices[key], position) if key in indices else np.array([position])
+    later_names = _concat_names[_concat_names.index(catalog_name) + 1:]
+    _catalog_index = {name: (offset + len(add_lookup) if name in later_names else offset, name_indices)
+                      for name, (offset, name_indices) in _catalog_index.items()}
+
+
+def _type_rows(lookup_type):
+    df = data()
+    if lookup_type not in _type_masks:  # masks are reset whenever the concatenated catalog is rebuilt
+        _type_masks[lookup_type] = _lookup_types == lookup_type
+    return df[_type_masks[lookup_type]]
+
+
+def _lookup_rows(identifier, lookup_type):
+    # always search all catalogs so that rows split or duplicated across catalogs are checked consistently
+    df = data()
+    key = (identifier, lookup_type)
+    rows = [offset + indices[key] for offset, indices in _catalog_index.values() if key in indices]
+    return df.iloc[np.concatenate(rows) if len(rows) > 0 else []]
+
+
 def list_stimulus_sets():
-    stimuli_rows = data()[data()['lookup_type'] == TYPE_STIMULUS_SET]
-    return sorted(list(set(stimuli_rows['identifier'])))
+    stimuli_rows = _type_rows(TYPE_STIMULUS_SET)
+    return _sorted_identifiers(stimuli_rows)
 
 
 def list_assemblies():
-    assembly_rows = data()[data()['lookup_type'] == TYPE_ASSEMBLY]
-    return sorted(list(set(assembly_rows['identifier'])))
+    assembly_rows = _type_rows(TYPE_ASSEMBLY)
+    return _sorted_identifiers(assembly_rows)
+
+
+def _sorted_identifiers(rows):
+    identifiers = pd.unique(rows['identifier'].values)
+    identifiers.sort()
+    return identifiers.tolist()
 
 
 def lookup_stimulus_set(identifier):
-    lookup = data()[(data()['identifier'] == identifier) & (data()['lookup_type'] == TYPE_STIMULUS_SET)]
+    lookup = _lookup_rows(identifier, TYPE_STIMULUS_SET)
     if len(lookup) == 0:
         raise StimulusSetLookupError(f"stimulus_set {identifier} not found")
-    csv_lookup = _lookup_stimulus_set_filtered(lookup, filter_func=_is_csv_lookup, label="CSV")
-    zip_lookup = _lookup_stimulus_set_filtered(lookup, filter_func=_is_zip_lookup, label="zip")
+    csv_mask, zip_mask = _stimulus_set_masks(lookup)
+    csv_lookup = _lookup_stimulus_set_filtered(lookup, mask=csv_mask, label="CSV")
+    zip_lookup = _lookup_stimulus_set_filtered(lookup, mask=zip_mask, label="zip")
     return csv_lookup, zip_lookup
 
 
-def _lookup_stimulus_set_filtered(lookup, filter_func, label):
-    cols = [n for n in lookup.columns if n != LOOKUP_SOURCE]
+def _lookup_stimulus_set_filtered(lookup, mask, label):
     # filter for csv vs. zip
-    # if there are any groups of rows where every field except source is the same,
-    # we only want one from each group
-    filtered_rows = lookup[lookup.apply(filter_func, axis=1)].drop_duplicates(subset=cols)
+    filtered_rows = _drop_source_duplicates(lookup[mask])
     identifier = lookup.iloc[0]['identifier']
     if len(filtered_rows) == 0:
         raise StimulusSetLookupError(f"{label} for stimulus set {identifier} not found")
@@ -89,19 +272,48 @@ def _lookup_stimulus_set_filtered(lookup, filter_func, label):
 
 
 def lookup_assembly(identifier):
-    lookup = data()[(data()['identifier'] == identifier) & (data()['lookup_type'] == TYPE_ASSEMBLY)]
+    lookup = _lookup_rows(identifier, TYPE_ASSEMBLY)
     if len(lookup) == 0:
         raise AssemblyLookupError(f"assembly {identifier} not found")
-    cols = [n for n in lookup.columns if n != LOOKUP_SOURCE]
-    # if there are any groups of rows where every field except source is the same,
-    # we only want one from each group
-    de_dupe = lookup.drop_duplicates(subset=cols)
+    de_dupe = _drop_source_duplicates(lookup)
     if len(de_dupe) > 1: # there were multiple rows but not all identical
         raise RuntimeError(f"Internal data inconsistency: Found multiple lookup rows for identifier {identifier}")
     assert len(de_dupe) == 1
     return de_dupe.squeeze()
 
 
+def lookup_assemblies(identifiers):
+    """
+    Look up several assemblies at once, with a single sort and binary search over the catalog.
+    :param identifiers: A list of assembly identifiers.
+    :return: A DataFrame with one lookup row per identifier, in the order of `identifiers`.
+    """
+    lookup = _drop_source_duplicates(_type_rows(TYPE_ASSEMBLY))
+    keys = lookup['identifier'].values.astype(str)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    identifiers = np.asarray(identifiers, dtype=str)
+    start = np.searchsorted(sorted_keys, identifiers, side='left')
+    end = np.searchsorted(sorted_keys, identifiers, side='right')
+    missing = identifiers[start == end]
+    if len(missing) > 0:
+        raise AssemblyLookupError(f"assemblies {', '.join(missing)} not found")
+    multiple = identifiers[end - start > 1]
+    if len(multiple) > 0:  # there were multiple rows but not all identical
+        raise RuntimeError(f"Internal data inconsistency: Found multiple lookup rows for identifiers "
+                           f"{', '.join(multiple)}")
+    return lookup.iloc[order[start]]
+
+
+def _drop_source_duplicates(lookup):
+    if len(lookup) <= 1:  # the common case, nothing to de-duplicate
+        return lookup
+    cols = [n for n in lookup.columns if n != LOOKUP_SOURCE]
+    # if there are any groups of rows where every field except source is the same,
+    # we only want one from each group
+    return lookup.drop_duplicates(subset=cols)
+
+
 class StimulusSetLookupError(KeyError):
     pass
 
@@ -112,13 +324,48 @@ class AssemblyLookupError(KeyError):
 
 def append(catalog_name, object_identifier, cls, lookup_type,
            bucket_name, sha1, s3_key, stimulus_set_identifier=None):
-    global _catalogs
-    global _concat_catalogs
-    catalogs = get_catalogs()
-    catalog = catalogs[catalog_name]
+    append_many(catalog_name, [dict(
+        object_identifier=object_identifier, cls=cls, lookup_type=lookup_type,
+        bucket_name=bucket_name, sha1=sha1, s3_key=s3_key, stimulus_set_identifier=stimulus_set_identifier)])
+
+
+def append_many(catalog_name, entries):
+    """
+    Add several lookup rows to a catalog, writing the catalog to disk only once.
+    :param catalog_name: The name of the lookup catalog to add the rows to.
+    :param entries: An iterable of dicts, each holding the keyword arguments of `append` except `catalog_name`.
+    """
+    catalog = get_catalog(catalog_name)
     catalog_path = Path(catalog.attrs[CATALOG_PATH_KEY])
+    if catalog_name not in _catalog_keys:
+        _catalog_keys[catalog_name] = set(zip(catalog['identifier'], catalog['lookup_type']))
+    keys = _catalog_keys[catalog_name]
+    rows, row_keys = [], set()
+    for entry in entries:
+        object_lookup = _object_lookup(catalog_name, **entry)
+        assert object_lookup['lookup_type'] in [TYPE_ASSEMBLY, TYPE_STIMULUS_SET]
+        key = (object_lookup['identifier'], object_lookup['lookup_type'])
+        if key in keys or key in row_keys:
+            _check_duplicates(catalog, rows, object_lookup)
+        rows.append(object_lookup)
+        row_keys.add(key)
+    # append and save
+    attrs = catalog.attrs
+    add_lookup = pd.DataFrame(rows)
+    catalog = pd.concat([catalog, add_lookup], ignore_index=True)
+    catalog.attrs = attrs
+    catalog.to_csv(catalog_path, index=False)
+    _write_lookup_cache(catalog_name, catalog, _entry_point_info(_catalog_loaders()[catalog_name]))
+    _catalogs[catalog_name] = catalog
+    keys.update(row_keys)
+    if _concat_catalogs is not None and catalog_name in _concat_names:
+        _insert_rows(catalog_name, add_lookup)
+
+
+def _object_lookup(catalog_name, object_identifier, cls, lookup_type,
+                   bucket_name, sha1, s3_key, stimulus_set_identifier=None):
     _logger.debug(f"Adding {lookup_type} {object_identifier} to catalog {catalog_name}")
-    object_lookup = {
+    return {
         'identifier': object_identifier,
         'lookup_type': lookup_type,
         'class': cls,
@@ -128,10 +375,15 @@ def append(catalog_name, object_identifier, cls, lookup_type,
         'stimulus_set_identifier': stimulus_set_identifier,
         'lookup_source': catalog_name,
     }
-    # check duplicates
-    assert object_lookup['lookup_type'] in [TYPE_ASSEMBLY, TYPE_STIMULUS_SET]
+
+
+def _check_duplicates(catalog, pending_rows, object_lookup):
     duplicates = catalog[(catalog['identifier'] == object_lookup['identifier']) &
-                           (catalog['lookup_type'] == object_lookup['lookup_type'])]
+                         (catalog['lookup_type'] == object_lookup['lookup_type'])]
+    pending_duplicates = [row for row in pending_rows if row['identifier'] == object_lookup['identifier']
+                          and row['lookup_type'] == object_lookup['lookup_type']]
+    if len(pending_duplicates) > 0:
+        duplicates = pd.concat([duplicates, pd.DataFrame(pending_duplicates)], ignore_index=True)
     if len(duplicates) > 0:
         if object_lookup['lookup_type'] == TYPE_ASSEMBLY:
             raise ValueError(f"Trying to add duplicate identifier {object_lookup['identifier']}, "
@@ -144,31 +396,84 @@ def append(catalog_name, object_identifier, cls, lookup_type,
             else:
                 raise ValueError(
                     f"Trying to add duplicate identifier {object_lookup['identifier']}, existing {duplicates}")
-    # append and save
-    add_lookup = pd.DataFrame({key: [value] for key, value in object_lookup.items()})
-    catalog = catalog.append(add_lookup)
-    catalog.to_csv(catalog_path, index=False)
-    _catalogs[catalog_name] = catalog
-    _concat_catalogs = None
 
 
 def _is_csv_lookup(data_row):
     return data_row['lookup_type'] == TYPE_STIMULUS_SET \
            and data_row['location'].endswith('.csv') \
-           and data_row['class'] not in [None, np.nan]
+           and pd.notna(data_row['class'])
 
 
 def _is_zip_lookup(data_row):
     return data_row['lookup_type'] == TYPE_STIMULUS_SET \
            and data_row['location'].endswith('.zip') \
-           and data_row['class'] in [None, np.nan]
+           and pd.isna(data_row['class'])
 
 
-def sha1_hash(path, buffer_size=64 * 2 ** 10):
-    sha1 = hashlib.sha1()
+def _stimulus_set_masks(lookup):
+    # vectorized equivalent of applying `_is_csv_lookup` and `_is_zip_lookup` to every row, in a single pass
+    location = lookup['location'].values.astype(str)
+    is_stimulus_set = lookup['lookup_type'].values == TYPE_STIMULUS_SET
+    has_class = lookup['class'].notna().values
+    csv_mask = is_stimulus_set & has_class & np.char.endswith(location, '.csv')
+    zip_mask = is_stimulus_set & ~has_class & np.char.endswith(location, '.zip')
+    return csv_mask, zip_mask
+
+
+def sha1_hash(path, buffer_size=2 ** 20):
+    # the same files are verified repeatedly, e.g. when loading an assembly multiple times. Only re-hash if changed
+    stat = os.stat(path)
+    return _sha1_hash_cached(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, buffer_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _sha1_hash_cached(path, mtime_ns, size, buffer_size):
+    return _sha1_hash_file(path, buffer_size)
+
+
+def _sha1_hash_file(path, buffer_size):
     with open(path, "rb") as f:
-        buffer = f.read(buffer_size)
-        while len(buffer) > 0:
-            sha1.update(buffer)
-            buffer = f.read(buffer_size)
+        if hasattr(hashlib, 'file_digest'):  # Python >= 3.11
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+        sha1 = hashlib.sha1()
+        with contextlib.closing(_read_chunks(f, buffer_size)) as chunks:  # stops the reader before the file closes
+            for buffer in chunks:
+                sha1.update(buffer)
     return sha1.hexdigest()
+
+
+def _read_chunks(f, buffer_size):
+    # read the next chunk in a background thread while the current one is being processed
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            buffer = f.read(buffer_size)
+            while len(buffer) > 0 and not stop.is_set():
+                chunks.put(buffer)
+                buffer = f.read(buffer_size)
+        except BaseException as e:
+            chunks.put(e)
+        finally:
+            chunks.put(None)  # always signal the end, even if reading failed
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        # the consumer may stop early: unblock the reader so that it can finish
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
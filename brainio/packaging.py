@@ -155,20 +155,16 @@ def package_stimulus_set(catalog_name, proto_stimulus_set, stimulus_set_identifi
     upload_to_s3(str(target_csv_path), bucket_name, target_s3_key=csv_file_name)
     upload_to_s3(str(target_zip_path), bucket_name, target_s3_key=zip_file_name)
     # link to csv and zip from same identifier. The csv however is the only one of the two rows with a class.
-    lookup.append(
-        catalog_name=catalog_name,
-        object_identifier=stimulus_set_identifier, cls='StimulusSet',
-        lookup_type=TYPE_STIMULUS_SET,
-        bucket_name=bucket_name, sha1=csv_sha1, s3_key=csv_file_name,
-        stimulus_set_identifier=None
-    )
-    lookup.append(
-        catalog_name=catalog_name,
-        object_identifier=stimulus_set_identifier, cls=None,
-        lookup_type=TYPE_STIMULUS_SET,
-        bucket_name=bucket_name, sha1=image_zip_sha1, s3_key=zip_file_name,
-        stimulus_set_identifier=None
-    )
+    lookup.append_many(catalog_name=catalog_name, entries=[
+        dict(object_identifier=stimulus_set_identifier, cls='StimulusSet',
+             lookup_type=TYPE_STIMULUS_SET,
+             bucket_name=bucket_name, sha1=csv_sha1, s3_key=csv_file_name,
+             stimulus_set_identifier=None),
+        dict(object_identifier=stimulus_set_identifier, cls=None,
+             lookup_type=TYPE_STIMULUS_SET,
+             bucket_name=bucket_name, sha1=image_zip_sha1, s3_key=zip_file_name,
+             stimulus_set_identifier=None),
+    ])
     _logger.debug(f"stimulus set {stimulus_set_identifier} packaged")
 
 
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import threading
 from pathlib import Path
 
 import pytest
@@ -61,6 +63,16 @@ def test_lookup_assy():
     assert assy['location'] == hvm_s3_url
 
 
+def test_lookup_assemblies():
+    identifiers = ["dicarlo.MajajHong2015.public", "dicarlo.MajajHong2015", "tolias.Cadena2017"]
+    assys = brainio.lookup.lookup_assemblies(identifiers)
+    assert list(assys['identifier']) == identifiers
+    for identifier, (_, assy) in zip(identifiers, assys.iterrows()):
+        assert assy['location'] == brainio.lookup.lookup_assembly(identifier)['location']
+    with pytest.raises(brainio.lookup.AssemblyLookupError):
+        brainio.lookup.lookup_assemblies(["dicarlo.MajajHong2015", "BadName"])
+
+
 def test_lookup_bad_name():
     with pytest.raises(brainio.lookup.AssemblyLookupError):
         brainio.lookup.lookup_assembly("BadName")
@@ -78,6 +90,80 @@ def test_catalogs():
     assert len(dfs["brainio_test2"]) == 9
     concat = brainio.lookup.data()
     assert len(concat) == len(dfs["brainio_test"]) + len(dfs["brainio_test2"])
+    assert concat['lookup_type'].dtype == dfs["brainio_test"]['lookup_type'].dtype
+
+
+def test_get_catalog():
+    catalog = brainio.lookup.get_catalog("brainio_test")
+    assert catalog.attrs[brainio.lookup.CATALOG_PATH_KEY].endswith("lookup.csv")
+    assert catalog is brainio.lookup.get_catalogs()["brainio_test"]
+
+
+@pytest.mark.parametrize('cache_format', ('json', 'parquet'))
+def test_lookup_cache(cache_format, tmp_path, monkeypatch):
+    if cache_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    monkeypatch.setattr(brainio.lookup, '_catalog_cache_path', tmp_path / "cache")
+    monkeypatch.setattr(brainio.lookup, '_catalog_cache_format', lambda: cache_format)
+    catalog_path = tmp_path / "lookup.csv"
+    catalog_path.write_text("identifier,lookup_type\nfoo,assembly\n")
+    catalog = pd.read_csv(catalog_path)
+    catalog.attrs[brainio.lookup.CATALOG_PATH_KEY] = str(catalog_path)
+    entry_point = brainio.lookup._catalog_loaders()["brainio_test"]
+    source = brainio.lookup._entry_point_info(entry_point)
+    assert source['entry_point'] == "brainio_test.entrypoint:brainio_test"
+    brainio.lookup._write_lookup_cache("test_cache", catalog, source)
+    cached = brainio.lookup._read_lookup_cache("test_cache", source)
+    pd.testing.assert_frame_equal(cached, catalog)
+    assert cached.attrs == catalog.attrs
+    # a different provider, e.g. after an upgrade, does not get the cached catalog
+    other_source = {**source, 'entry_point': "brainio_test.entrypoint:brainio_test2"}
+    assert brainio.lookup._read_lookup_cache("test_cache", other_source) is None
+    assert brainio.lookup._read_lookup_cache("test_cache", {**source, 'module_mtime_ns': 0}) is None
+    # neither does a changed catalog file
+    catalog_path.write_text("identifier,lookup_type\nfoo,assembly\nbar,assembly\n")
+    assert brainio.lookup._read_lookup_cache("test_cache", source) is None
+
+
+def test_lookup_after_partial_load(monkeypatch):
+    for name, value in [('_catalogs', {}), ('_concat_catalogs', None), ('_concat_names', ()),
+                        ('_catalog_index', None), ('_type_masks', {})]:
+        monkeypatch.setattr(brainio.lookup, name, value)
+    brainio.lookup.get_catalog("brainio_test")
+    # only in the catalog that has not been loaded yet
+    assy = brainio.lookup.lookup_assembly("dicarlo.MajajHong2015.public")
+    assert assy['lookup_source'] == "brainio_test2"
+    stim_csv, stim_zip = brainio.lookup.lookup_stimulus_set("dicarlo.hvm")
+    assert stim_csv['location'].endswith(".csv")
+    assert stim_zip['location'].endswith(".zip")
+
+
+def test_lookup_source_independent_of_load_order(monkeypatch):
+    for name, value in [('_catalogs', {}), ('_concat_catalogs', None), ('_concat_names', ()),
+                        ('_catalog_index', None), ('_type_masks', {})]:
+        monkeypatch.setattr(brainio.lookup, name, value)
+    brainio.lookup.get_catalog("brainio_test2")  # load the second catalog first
+    # rows that are identical in both catalogs are reported from the first one, like in a fresh process
+    assert brainio.lookup.lookup_assembly("dicarlo.MajajHong2015")['lookup_source'] == "brainio_test"
+    assert brainio.lookup.lookup_stimulus_set("dicarlo.hvm")[0]['lookup_source'] == "brainio_test"
+    assert list(brainio.lookup.data()['lookup_source'].unique()) == ["brainio_test", "brainio_test2"]
+
+
+def test_lookup_cache_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(brainio.lookup, '_catalog_cache_path', tmp_path / "cache")
+    source = brainio.lookup._entry_point_info(brainio.lookup._catalog_loaders()["brainio_test"])
+    catalog = pd.DataFrame({'identifier': ["foo"], 'lookup_type': ["assembly"]})
+    # a catalog path that does not exist is not an error, the catalog just is not cached
+    catalog.attrs[brainio.lookup.CATALOG_PATH_KEY] = str(tmp_path / "missing.csv")
+    brainio.lookup._write_lookup_cache("test_cache", catalog, source)
+    assert brainio.lookup._read_lookup_cache("test_cache", source) is None
+    # neither is a catalog file that changed after loading started
+    catalog_path = tmp_path / "lookup.csv"
+    catalog_path.write_text("identifier,lookup_type\nfoo,assembly\n")
+    catalog.attrs[brainio.lookup.CATALOG_PATH_KEY] = str(catalog_path)
+    brainio.lookup._write_lookup_cache("test_cache", catalog, source,
+                                       modified_before_ns=catalog_path.stat().st_mtime_ns)
+    assert brainio.lookup._read_lookup_cache("test_cache", source) is None
 
 
 def test_duplicates():
@@ -103,4 +189,56 @@ def test_duplicates():
     assert len(all_lookups[match_c17 & match_assy]) == 1
 
 
+def test_lookup_masks():
+    all_lookups = brainio.lookup.data()
+    match_csv = all_lookups.apply(brainio.lookup._is_csv_lookup, axis=1)
+    match_zip = all_lookups.apply(brainio.lookup._is_zip_lookup, axis=1)
+    csv_mask, zip_mask = brainio.lookup._stimulus_set_masks(all_lookups)
+    assert np.array_equal(csv_mask, match_csv.values)
+    assert np.array_equal(zip_mask, match_zip.values)
+
+
+@pytest.mark.parametrize('filename', ('images/n0.png', 'video_0.mp4'))
+def test_sha1_hash(filename):
+    path = Path(__file__).parent / filename
+    expected = hashlib.sha1(path.read_bytes()).hexdigest()
+    assert brainio.lookup.sha1_hash(path) == expected
+
+
+@pytest.mark.parametrize('filename', ('images/n0.png', 'video_0.mp4'))
+def test_sha1_hash_chunked(filename, monkeypatch):
+    monkeypatch.delattr(hashlib, 'file_digest', raising=False)  # hash through the background reader
+    brainio.lookup._sha1_hash_cached.cache_clear()
+    path = Path(__file__).parent / filename
+    expected = hashlib.sha1(path.read_bytes()).hexdigest()
+    assert brainio.lookup.sha1_hash(path) == expected
+    assert brainio.lookup.sha1_hash(path, buffer_size=1024) == expected
+
+
+def test_read_chunks_stopped_early():
+    threads = threading.active_count()
+    with open(Path(__file__).parent / 'video_0.mp4', 'rb') as f:
+        chunks = brainio.lookup._read_chunks(f, buffer_size=1024)
+        next(chunks)
+        chunks.close()
+    assert threading.active_count() == threads
+
+
+def test_read_chunks_failed_read():
+    class FailingFile:
+        def read(self, size):
+            raise OSError("read failed")
+
+    with pytest.raises(OSError):
+        list(brainio.lookup._read_chunks(FailingFile(), buffer_size=1024))
+
+
+def test_sha1_hash_changed_file(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"foo")
+    assert brainio.lookup.sha1_hash(path) == hashlib.sha1(b"foo").hexdigest()
+    path.write_bytes(b"foobar")
+    assert brainio.lookup.sha1_hash(path) == hashlib.sha1(b"foobar").hexdigest()
+
+
 
@@ -3,6 +3,7 @@ from pathlib import Path
 import pytest
 
 import brainio
+import pandas as pd
 from pandas import DataFrame
 
 from brainio.assemblies import DataAssembly, get_levels
@@ -99,6 +100,30 @@ def test_append():
     lookup.append(TEST_CATALOG_NAME, identifier, "DataAssembly", TYPE_ASSEMBLY, "brainio-temp", netcdf_sha1, "assy_test_append.nc", "dicarlo.hvm")
     assert identifier in list(lookup.get_catalogs()[TEST_CATALOG_NAME]["identifier"])
     assert identifier in lookup.list_assemblies()
+    assert lookup.lookup_assembly(identifier)['sha1'] == netcdf_sha1
+
+
+def test_append_many():
+    identifier = "test.append_many"
+    entries = [
+        dict(object_identifier=identifier, cls='StimulusSet', lookup_type=TYPE_STIMULUS_SET,
+             bucket_name="brainio-temp", sha1="abc", s3_key="image_test_append_many.csv"),
+        dict(object_identifier=identifier, cls=None, lookup_type=TYPE_STIMULUS_SET,
+             bucket_name="brainio-temp", sha1="def", s3_key="image_test_append_many.zip"),
+    ]
+    lookup.append_many(TEST_CATALOG_NAME, entries)
+    assert identifier in lookup.list_stimulus_sets()
+    # appended rows stay within their catalog's slice, like in a freshly concatenated catalog
+    fresh = pd.concat([lookup.get_catalogs()[name] for name in lookup.list_catalogs()], ignore_index=True)
+    pd.testing.assert_frame_equal(lookup.data(), fresh)
+    # rows of the following catalog moved back, and are still found
+    assert lookup.lookup_assembly("dicarlo.MajajHong2015.public")['lookup_source'] == "brainio_test2"
+    assert "dicarlo.hvm-public" in lookup.list_stimulus_sets()
+    csv_lookup, zip_lookup = lookup.lookup_stimulus_set(identifier)
+    assert csv_lookup['sha1'] == "abc"
+    assert zip_lookup['sha1'] == "def"
+    with pytest.raises(ValueError):
+        lookup.append_many(TEST_CATALOG_NAME, entries[:1])
 
 
 @pytest.mark.private_access